@@ -6,6 +6,7 @@ import tempfile
 import json
 import subprocess
 import sys
+from concurrent.futures import ThreadPoolExecutor
 from flask import Flask, request, jsonify, render_template
 from werkzeug.utils import secure_filename
 from dotenv import load_dotenv
@@ -14,7 +15,10 @@ from dotenv import load_dotenv
 load_dotenv()
 
 # Import our modular components
-from barcode_scanner import fetch_openfood, scan_barcode_from_image
+from barcode_scanner import (
+    fetch_openfood, scan_barcode_from_image, scan_barcodes_from_image, MAX_PRODUCTS_PER_IMAGE, LOOKUP_WORKERS
+)
+from barcode_localizer import scan_stats
 from nutrition_analyzer import calculate_nutrition_score
 from utils import clean_markdown, validate_file_upload
 
@@ -110,6 +114,85 @@ def analyze_image():
     except Exception as e:
         return jsonify({'error': str(e), 'show_manual': True}), 500
 
+def _score_product(nutrition_data):
+    """Score one shelf product; a failed LLM call returns (None, error) instead of raising"""
+    try:
+        return calculate_nutrition_score(nutrition_data)
+    except Exception as e:
+        return None, f"Scoring failed: {str(e)}"
+
+
+@app.route('/analyze_shelf', methods=['POST'])
+def analyze_shelf():
+    """Analyze every product barcode visible in a shelf or case photo"""
+    try:
+        if 'image' not in request.files:
+            return jsonify({'error': 'No image file provided'}), 400
+        
+        file = request.files['image']
+        if file.filename == '':
+            return jsonify({'error': 'No file selected'}), 400
+
+        max_products = request.form.get('max_products', MAX_PRODUCTS_PER_IMAGE, type=int)
+        if not 1 <= max_products <= MAX_PRODUCTS_PER_IMAGE:
+            return jsonify({'error': f'max_products must be between 1 and {MAX_PRODUCTS_PER_IMAGE}'}), 400
+
+        filename = secure_filename(file.filename)
+        temp_dir = tempfile.gettempdir()
+        temp_path = os.path.join(temp_dir, filename)
+        file.save(temp_path)
+
+        try:
+            try:
+                detections = scan_barcodes_from_image(temp_path, max_products=max_products)
+            except Exception as scan_error:
+                return jsonify({'error': str(scan_error), 'show_manual': True}), 400
+
+            # Score each distinct product once, in parallel
+            found = {d['barcode']: d['nutrition_data'] for d in detections if 'nutrition_data' in d}
+            scores = {}
+            if found:
+                with ThreadPoolExecutor(max_workers=min(len(found), LOOKUP_WORKERS)) as pool:
+                    scores = dict(zip(found, pool.map(_score_product, found.values())))
+
+            products = []
+            not_found = []
+            failed = []
+            for det in detections:
+                if det['barcode'] not in scores:
+                    not_found.append({'barcode': det['barcode'], 'bbox': det['bbox'], 'error': det['error']})
+                    continue
+                score, comment = scores[det['barcode']]
+                if score is None:
+                    failed.append({'barcode': det['barcode'], 'bbox': det['bbox'], 'error': comment})
+                    continue
+                products.append({
+                    'barcode': det['barcode'],
+                    'bbox': det['bbox'],
+                    'score': score,
+                    'comment': clean_markdown(comment),
+                    'details': json.dumps(det['nutrition_data'], indent=2)
+                })
+
+            return jsonify({
+                'products': products,
+                'not_found': not_found,
+                'failed': failed
+            })
+
+        finally:
+            # Clean up temporary file
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    except Exception as e:
+        return jsonify({'error': str(e), 'show_manual': True}), 500
+
+@app.route('/scan_stats', methods=['GET'])
+def get_scan_stats():
+    """Per-stage barcode decode timing and localization hit rate for image uploads"""
+    return jsonify(scan_stats.summary())
+
 @app.route('/start_live_scan', methods=['POST'])
 def start_live_scan():
     """Start the live camera barcode scanner and return results"""
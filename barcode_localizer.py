@@ -0,0 +1,315 @@
+"""
+Barcode region localization with OpenCV ahead of pyzbar decoding
+"""
+import threading
+import time
+from collections import namedtuple
+from contextlib import contextmanager
+
+import cv2
+import numpy as np
+from pyzbar.pyzbar import decode
+
+LOCALIZE_MAX_SIDE = 640    # Localization runs on a downscaled copy of this size
+TENSOR_WINDOW = 9          # Window for the local gradient statistics (px, resized image)
+MIN_COHERENCE = 0.85       # 1.0 = all gradients parallel, as across barcode bars
+MIN_EDGE_DENSITY = 0.5     # Share of the window on strong edges along the dominant direction
+MIN_EDGE_BALANCE = 0.2     # Share on rising and on falling edges; one edge only has one sign
+EDGE_THRESHOLD = 0.2       # Strong edge = this fraction of the 99th percentile gradient
+MIN_EDGE_CHANGES = 10      # Bar/space alternations a verified candidate must show
+MAX_ROW_DEVIATION = 0.2    # Row variance around the bar profile, relative to the profile's
+MIN_REGION_AREA = 0.002    # Smallest candidate, as a fraction of the image area
+MAX_REGION_AREA = 0.8      # Larger candidates are background, not a barcode
+MIN_ASPECT = 0.5           # Width across the bars over bar length: below is stripes/seals,
+MAX_ASPECT = 6             # above is too many too-short "bars" (e.g. lines of text)
+CLOSE_LENGTH = 21          # Gap across the bars bridged when joining candidate pixels
+MAX_REGIONS = 6            # Candidates decoded per image/frame, largest first
+REGION_PADDING = 0.15      # Extra margin around each crop for the quiet zone
+MIN_BARCODE_WIDTH = 300    # Narrower barcodes are upscaled (~3px per EAN-13 module)
+MAX_UPSCALE = 4
+
+LocalizedBarcode = namedtuple('LocalizedBarcode', ['data', 'type', 'rect', 'polygon', 'angle'])
+
+
+class LocalizationStats:
+    """Thread-safe per-stage timing and localization hit rate"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.images = 0
+            self.hits = 0
+            self.stage_calls = {}
+            self.stage_seconds = {}
+
+    @contextmanager
+    def stage(self, name):
+        """Time a block of work under the given stage name"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                self.stage_calls[name] = self.stage_calls.get(name, 0) + 1
+                self.stage_seconds[name] = self.stage_seconds.get(name, 0.0) + elapsed
+
+    def record(self, hit):
+        """Count one image/frame, and whether its localized regions decoded"""
+        with self._lock:
+            self.images += 1
+            if hit:
+                self.hits += 1
+
+    def summary(self):
+        with self._lock:
+            return {
+                'images': self.images,
+                'localization_hits': self.hits,
+                'hit_rate': round(self.hits / self.images, 3) if self.images else None,
+                'stages': {
+                    name: {
+                        'calls': calls,
+                        'total_ms': round(self.stage_seconds[name] * 1000, 1),
+                        'avg_ms': round(self.stage_seconds[name] * 1000 / calls, 2),
+                    }
+                    for name, calls in self.stage_calls.items()
+                },
+            }
+
+
+# Shared stats for the web app; the live scanner keeps its own
+scan_stats = LocalizationStats()
+
+
+def _structure_tensor(img):
+    """Scharr gradients and their locally averaged structure tensor"""
+    gx = cv2.Scharr(img, cv2.CV_32F, 1, 0)
+    gy = cv2.Scharr(img, cv2.CV_32F, 0, 1)
+    window = (TENSOR_WINDOW, TENSOR_WINDOW)
+    jxx = cv2.boxFilter(gx * gx, -1, window)
+    jyy = cv2.boxFilter(gy * gy, -1, window)
+    jxy = cv2.boxFilter(gx * gy, -1, window)
+    return gx, gy, jxx, jyy, jxy
+
+
+def _bar_mask(gx, gy, jxx, jyy, jxy):
+    """Mark pixels that sit in a run of alternating parallel edges
+
+    Returns the mask and the local orientation as a doubled-angle unit vector
+    (cos 2t, sin 2t), t being the dominant gradient direction.
+    """
+    diff = jxx - jyy
+    norm = np.sqrt(diff * diff + 4 * jxy * jxy) + 1e-6
+    coherence = norm / (jxx + jyy + 1e-6)
+    cos2, sin2 = diff / norm, 2 * jxy / norm
+
+    # Project each gradient onto the local dominant direction and count
+    # rising and falling edges separately
+    cos_t = np.sqrt((1 + cos2) / 2)
+    sin_t = np.copysign(np.sqrt(np.maximum(1 - cos2, 0) / 2), sin2)
+    projected = gx * cos_t + gy * sin_t
+    threshold = EDGE_THRESHOLD * np.percentile(np.abs(projected[::4, ::4]), 99)
+    window = (TENSOR_WINDOW, TENSOR_WINDOW)
+    rising = cv2.blur((projected > threshold).astype(np.uint8) * 255, window).astype(np.float32) / 255
+    falling = cv2.blur((projected < -threshold).astype(np.uint8) * 255, window).astype(np.float32) / 255
+
+    mask = ((coherence > MIN_COHERENCE)
+            & (rising + falling > MIN_EDGE_DENSITY)
+            & (np.minimum(rising, falling) > MIN_EDGE_BALANCE)).astype(np.uint8)
+    return mask, cos2, sin2
+
+
+def _line_kernel(angle, length):
+    """Structuring element: a line at the given angle (degrees)"""
+    kernel = np.zeros((length, length), dtype=np.uint8)
+    half = (length - 1) / 2
+    dx, dy = half * np.cos(np.radians(angle)), half * np.sin(np.radians(angle))
+    cv2.line(kernel, (round(half - dx), round(half - dy)), (round(half + dx), round(half + dy)), 1)
+    return kernel
+
+
+def find_barcode_regions(gray, max_regions=MAX_REGIONS, max_side=LOCALIZE_MAX_SIDE):
+    """Find likely 1D barcode regions in a grayscale image
+
+    A barcode is a run of parallel edges that alternate between dark-to-light
+    and light-to-dark. Candidate pixels need coherent gradients (structure
+    tensor), a high density of strong edges along the dominant gradient
+    direction, and plenty of both edge signs - a single straight edge such as
+    a package outline only has one. Pixels are grouped by orientation so a
+    barcode doesn't merge with nearby rules or borders, and each candidate
+    must show many bars once deskewed. Returns a list of dicts with 'box'
+    (4 corner points, original image coordinates), 'angle' (degrees of the
+    gradient direction, i.e. perpendicular to the bars), and 'width'/'height'
+    (extent across/along the bars, original pixels).
+    """
+    height, width = gray.shape[:2]
+    scale = min(1.0, max_side / max(height, width))
+    small = gray if scale == 1.0 else cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    small_h, small_w = small.shape[:2]
+
+    # Second pass at half size catches close-up barcodes with wide bars
+    mask, cos2, sin2 = _bar_mask(*_structure_tensor(small))
+    coarse = [cv2.resize(m, (small_w, small_h), interpolation=cv2.INTER_NEAREST)
+              for m in _bar_mask(*_structure_tensor(cv2.pyrDown(small)))]
+    cos2 = np.where(mask > 0, cos2, coarse[1])
+    sin2 = np.where(mask > 0, sin2, coarse[2])
+    mask = mask | coarse[0]
+
+    image_area = small_h * small_w
+    open_kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (5, 5))
+    candidates = []
+    # Overlapping orientation bins, each +-45 degrees around its centre, so
+    # orientations 90 degrees apart (bars and a rule across them) never share one
+    bins = ((0, cos2 > 0), (45, sin2 > 0), (90, cos2 < 0), (135, sin2 < 0))
+    for center, in_bin in bins:
+        bin_mask = mask & in_bin
+
+        # Open first so bars don't merge with neighbouring edges, then bridge
+        # gaps across the bars (e.g. the centre guard) but not along them
+        bin_mask = cv2.morphologyEx(bin_mask, cv2.MORPH_OPEN, open_kernel)
+        bin_mask = cv2.morphologyEx(bin_mask, cv2.MORPH_CLOSE, _line_kernel(center, CLOSE_LENGTH))
+        contours, _ = cv2.findContours(bin_mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        candidates.extend(
+            (c, in_bin) for c in contours
+            if MIN_REGION_AREA * image_area <= cv2.contourArea(c) <= MAX_REGION_AREA * image_area
+        )
+    candidates.sort(key=lambda candidate: cv2.contourArea(candidate[0]), reverse=True)
+
+    regions = []
+    small_boxes = []
+    for contour, in_bin in candidates:
+        x, y, w, h = cv2.boundingRect(contour)
+        if x == 0 or y == 0 or x + w == small_w or y + h == small_h:
+            continue  # Cut off by the frame (undecodable), or a border/seal
+
+        # Skip the same barcode found again in the neighbouring orientation bin
+        cx, cy = (float(v) for v in contour.reshape(-1, 2).mean(axis=0))
+        if any(cv2.pointPolygonTest(b, (cx, cy), False) >= 0 for b in small_boxes):
+            continue
+
+        # Dominant orientation of this region's bar pixels, each counted once
+        # so a strong nearby edge can't outweigh faint bars
+        inside = np.zeros((h, w), dtype=np.uint8)
+        cv2.drawContours(inside, [contour - (x, y)], -1, 1, thickness=-1)
+        inside = inside.astype(bool) & (mask[y:y + h, x:x + w] > 0) & in_bin[y:y + h, x:x + w]
+        angle = 0.5 * np.arctan2(sin2[y:y + h, x:x + w][inside].sum(), cos2[y:y + h, x:x + w][inside].sum())
+
+        # Box aligned with the bars: extent across (u) and along (v) them
+        cos_a, sin_a = np.cos(angle), np.sin(angle)
+        points = contour.reshape(-1, 2).astype(np.float32)
+        u = points[:, 0] * cos_a + points[:, 1] * sin_a
+        v = -points[:, 0] * sin_a + points[:, 1] * cos_a
+        # The window and the opening trim the bar ends; restore them
+        v_min, v_max = v.min() - TENSOR_WINDOW // 2, v.max() + TENSOR_WINDOW // 2
+        across, along = u.max() - u.min() + 1, v_max - v_min + 1
+        if not MIN_ASPECT * along <= across <= MAX_ASPECT * along:
+            continue  # Long thin stripes (seals, rules) or stacked text lines
+
+        corners = [(u.min(), v_min), (u.max(), v_min), (u.max(), v_max), (u.min(), v_max)]
+        box = np.array([(cu * cos_a - cv_ * sin_a, cu * sin_a + cv_ * cos_a) for cu, cv_ in corners])
+        if not _has_bar_pattern(_deskew(small, box, np.degrees(angle))):
+            continue
+
+        small_boxes.append(box.astype(np.float32).reshape(-1, 1, 2))
+        regions.append({
+            'box': (box / scale).round().astype(np.int32),
+            'angle': float(np.degrees(angle)),
+            'width': float(across / scale),
+            'height': float(along / scale),
+        })
+        if len(regions) == max_regions:
+            break
+
+    return regions
+
+
+def _deskew(gray, box, angle, padding=0.0, zoom=1.0):
+    """Warp the box (rotated by angle degrees) into an upright crop"""
+    box = np.asarray(box, dtype=np.float32)
+    center = tuple(float(v) for v in box.mean(axis=0))
+    matrix = cv2.getRotationMatrix2D(center, angle, 1.0)
+
+    # Where the box ends up after rotation, plus any margin
+    rotated = cv2.transform(box.reshape(-1, 1, 2), matrix).reshape(-1, 2)
+    x0, y0 = rotated.min(axis=0)
+    x1, y1 = rotated.max(axis=0)
+    pad_x = (x1 - x0) * padding
+    pad_y = (y1 - y0) * padding
+    x0, y0, x1, y1 = x0 - pad_x, y0 - pad_y, x1 + pad_x, y1 + pad_y
+
+    # Warp straight into the crop so only the output pixels are computed
+    matrix[0, 2] -= x0
+    matrix[1, 2] -= y0
+    matrix *= zoom
+    size = (max(int((x1 - x0) * zoom), 1), max(int((y1 - y0) * zoom), 1))
+    return cv2.warpAffine(gray, matrix, size, flags=cv2.INTER_CUBIC, borderMode=cv2.BORDER_REPLICATE)
+
+
+def _has_bar_pattern(crop):
+    """Check a deskewed candidate for many bars that run its full height
+
+    Counts direction changes of the intensity profile across the bars, and
+    requires every row to follow that profile - text lines and tables vary
+    along their length, bars don't.
+    """
+    crop = crop.astype(np.float32)
+    h = crop.shape[0]
+    band = crop[h // 4:max(3 * h // 4, h // 4 + 1)]
+    profile = band.mean(axis=0)
+    spread = profile.var()
+    if spread == 0:
+        return False
+
+    steps = np.diff(profile)
+    steps = steps[np.abs(steps) > 0.1 * (profile.max() - profile.min())]
+    if np.count_nonzero(np.diff(np.sign(steps))) < MIN_EDGE_CHANGES:
+        return False
+    return ((band - profile) ** 2).mean() / spread <= MAX_ROW_DEVIATION
+
+
+def extract_region(gray, region):
+    """Crop a region and rotate it so the barcode bars are vertical"""
+    # Upscale small barcodes in the same warp so zbar gets a few px per module
+    zoom = 1.0
+    if region['width'] < MIN_BARCODE_WIDTH:
+        zoom = min(float(np.ceil(MIN_BARCODE_WIDTH / max(region['width'], 1.0))), MAX_UPSCALE)
+    return _deskew(gray, region['box'], region['angle'], REGION_PADDING, zoom)
+
+
+def decode_localized(gray, symbols=None, stats=None, full_image_fallback=True, max_side=LOCALIZE_MAX_SIDE):
+    """Decode barcodes from localized regions, falling back to the whole image
+
+    Returns a list of LocalizedBarcode. For localized hits the rect/polygon are
+    those of the detected region in the original image. Set
+    full_image_fallback=False when the caller has its own fallback, or to skip
+    it on frames where a full decode isn't worth the cost. max_side is the
+    resolution localization runs at.
+    """
+    stats = stats or scan_stats
+
+    with stats.stage('localize'):
+        regions = find_barcode_regions(gray, max_side=max_side)
+
+    found = []
+    if regions:
+        seen = set()
+        with stats.stage('decode_regions'):
+            for region in regions:
+                for r in decode(extract_region(gray, region), symbols=symbols):
+                    if r.data in seen:
+                        continue
+                    seen.add(r.data)
+                    polygon = [tuple(int(v) for v in point) for point in region['box']]
+                    found.append(LocalizedBarcode(r.data, r.type, cv2.boundingRect(region['box']), polygon, region['angle']))
+
+    stats.record(hit=bool(found))
+    if found or not full_image_fallback:
+        return found
+
+    with stats.stage('decode_full'):
+        results = decode(gray, symbols=symbols)
+    return [LocalizedBarcode(r.data, r.type, tuple(r.rect), [tuple(p) for p in r.polygon], 0.0) for r in results]
@@ -1,11 +1,26 @@
 """
 Barcode scanning and OpenFoodFacts API integration modules
 """
+import os
 import requests
 import json
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 from PIL import Image, ImageOps
 from pyzbar.pyzbar import decode, ZBarSymbol
 
+from barcode_localizer import decode_localized, scan_stats
+
+BARCODE_SYMBOLS = [ZBarSymbol.EAN13, ZBarSymbol.EAN8, ZBarSymbol.UPCA, ZBarSymbol.UPCE]
+
+# Multi-product (shelf/pallet) scanning
+MAX_PRODUCTS_PER_IMAGE = 50
+TILE_SIZE = 1200          # Minimum tile edge in pixels
+TILE_OVERLAP = 400        # Minimum overlap between neighbouring tiles, in pixels
+TILE_OVERLAP_FRACTION = 0.2  # Overlap as a share of the long side: barcodes up to 20% of it fit whole in some tile
+DUPLICATE_OVERLAP = 0.5   # Same value + this much box overlap = same physical barcode
+LOOKUP_WORKERS = 8        # Concurrent OpenFoodFacts requests
+
 
 def validate_and_format_barcode(barcode):
     """Validate and format barcode for OpenFoodFacts"""
@@ -69,15 +84,66 @@ def fetch_openfood(barcode):
         return None, "Invalid response from API"
 
 
-def scan_barcode_from_image(image_path):
+def _fetch_decoded(barcode_type, digits):
+    """Look up a decoded barcode on OpenFoodFacts, returning nutriments or None"""
+    # Handle different barcode types
+    if barcode_type == "EAN13" and len(digits) == 13:
+        data, error = fetch_openfood(digits)
+        if not error:
+            return data
+    elif barcode_type == "UPCA" and len(digits) == 12:
+        # Try UPC-A as is, then with leading zero
+        data, error = fetch_openfood(digits)
+        if not error:
+            return data
+        # Try with leading zero to make it EAN-13
+        data, error = fetch_openfood("0" + digits)
+        if not error:
+            return data
+    elif barcode_type == "EAN8" and len(digits) == 8:
+        data, error = fetch_openfood(digits)
+        if not error:
+            return data
+    elif barcode_type == "UPCE" and len(digits) >= 6:
+        # UPC-E needs to be converted to UPC-A format
+        data, error = fetch_openfood(digits)
+        if not error:
+            return data
+
+    # If we have any valid barcode digits, try as generic barcode
+    if len(digits) >= 8:
+        data, error = fetch_openfood(digits)
+        if not error:
+            return data
+
+    return None
+
+
+def _barcode_digits(result):
+    """Extract the digits from a pyzbar decode result"""
+    return "".join(ch for ch in result.data.decode("utf-8", "ignore") if ch.isdigit())
+
+
+def scan_barcode_from_image(image_path, stats=None):
     """Extract barcode from image and get nutrition data"""
+    stats = stats or scan_stats
     try:
         img = Image.open(image_path)
     except Exception as e:
         raise Exception(f"Error opening image: {e}")
 
-    symbols = [ZBarSymbol.EAN13, ZBarSymbol.EAN8, ZBarSymbol.UPCA, ZBarSymbol.UPCE]
+    # Decode only the regions OpenCV localizes; they are already deskewed
+    gray = ImageOps.autocontrast(ImageOps.grayscale(img))
+    results = decode_localized(np.asarray(gray), symbols=BARCODE_SYMBOLS,
+                               stats=stats, full_image_fallback=False)
+    for r in results:
+        data = _fetch_decoded(r.type, _barcode_digits(r))
+        if data:
+            return data
+    if results:
+        raise Exception("No barcode found in image")
 
+    # Fallback: blind rotations over the whole (upscaled) image
     for angle in (0, 90, 180, 270):
         im = img.rotate(angle, expand=True)
         im = ImageOps.grayscale(im)
@@ -85,39 +151,127 @@ def scan_barcode_from_image(image_path):
         if min(im.size) < 1000:
             im = im.resize((im.width * 2, im.height * 2))
 
-        results = decode(im, symbols=symbols)
+        with stats.stage('decode_rotations'):
+            results = decode(im, symbols=BARCODE_SYMBOLS)
         if results:
             for r in results:
-                s = "".join(ch for ch in r.data.decode("utf-8", "ignore") if ch.isdigit())
-                
-                # Handle different barcode types
-                if r.type == "EAN13" and len(s) == 13:
-                    data, error = fetch_openfood(s)
-                    if not error:
-                        return data
-                elif r.type == "UPCA" and len(s) == 12:
-                    # Try UPC-A as is, then with leading zero
-                    data, error = fetch_openfood(s)
-                    if not error:
-                        return data
-                    # Try with leading zero to make it EAN-13
-                    data, error = fetch_openfood("0" + s)
-                    if not error:
-                        return data
-                elif r.type == "EAN8" and len(s) == 8:
-                    data, error = fetch_openfood(s)
-                    if not error:
-                        return data
-                elif r.type == "UPCE" and len(s) >= 6:
-                    # UPC-E needs to be converted to UPC-A format
-                    data, error = fetch_openfood(s)
-                    if not error:
-                        return data
-                
-                # If we have any valid barcode digits, try as generic barcode
-                if len(s) >= 8:
-                    data, error = fetch_openfood(s)
-                    if not error:
-                        return data
-
-    raise Exception("No barcode found in image")
\ No newline at end of file
+                data = _fetch_decoded(r.type, _barcode_digits(r))
+                if data:
+                    return data
+
+    raise Exception("No barcode found in image")
+
+
+def _tile_boxes(width, height, tile_size, overlap):
+    """Split an image into evenly spread, overlapping (left, top, right, bottom) tiles"""
+    def spans(length):
+        # Fewest tiles of roughly tile_size that keep the full overlap between neighbours
+        count = max(1, round((length - overlap) / (tile_size - overlap)))
+        size = -(-(length + (count - 1) * overlap) // count)
+        return [(i * (size - overlap), min(i * (size - overlap) + size, length)) for i in range(count)]
+
+    return [
+        (left, top, right, bottom)
+        for top, bottom in spans(height)
+        for left, right in spans(width)
+    ]
+
+
+def _decode_tile(im, box, scale):
+    """Decode one tile and map detections back to original image coordinates"""
+    tile = im.crop(box)
+    if scale != 1:
+        tile = tile.resize((tile.width * scale, tile.height * scale))
+
+    detections = []
+    for r in decode(tile, symbols=BARCODE_SYMBOLS):
+        left, top, width, height = r.rect
+        detections.append({
+            'barcode': _barcode_digits(r),
+            'type': r.type,
+            'bbox': {
+                'x': box[0] + left // scale,
+                'y': box[1] + top // scale,
+                'width': width // scale,
+                'height': height // scale,
+            },
+        })
+    return detections
+
+
+def _box_overlap(a, b):
+    """Intersection area over the smaller box's area"""
+    # zbar can report 1D barcodes as very thin boxes; give them at least 1px
+    aw, ah = max(a['width'], 1), max(a['height'], 1)
+    bw, bh = max(b['width'], 1), max(b['height'], 1)
+    ix = max(0, min(a['x'] + aw, b['x'] + bw) - max(a['x'], b['x']))
+    iy = max(0, min(a['y'] + ah, b['y'] + bh) - max(a['y'], b['y']))
+    return (ix * iy) / min(aw * ah, bw * bh)
+
+
+def _merge_detections(detections):
+    """Deduplicate detections of the same barcode seen by overlapping tiles"""
+    merged = []
+    for det in detections:
+        if not det['barcode']:
+            continue
+        for kept in merged:
+            if (kept['barcode'] == det['barcode']
+                    and _box_overlap(kept['bbox'], det['bbox']) >= DUPLICATE_OVERLAP):
+                # Keep the larger box - the other tile likely cut the barcode off
+                if det['bbox']['width'] * det['bbox']['height'] > kept['bbox']['width'] * kept['bbox']['height']:
+                    kept['bbox'] = det['bbox']
+                break
+        else:
+            merged.append(det)
+
+    # Reading order: top to bottom, then left to right
+    merged.sort(key=lambda d: (d['bbox']['y'], d['bbox']['x']))
+    return merged
+
+
+def scan_barcodes_from_image(image_path, max_products=MAX_PRODUCTS_PER_IMAGE):
+    """Find every barcode in a shelf/case image and get nutrition data for each
+
+    Large images are split into overlapping tiles that are decoded in parallel.
+    Returns a list of dicts with 'barcode', 'type', 'bbox' and either
+    'nutrition_data' or 'error', one per distinct barcode location.
+    """
+    try:
+        img = Image.open(image_path)
+    except Exception as e:
+        raise Exception(f"Error opening image: {e}")
+
+    im = ImageOps.grayscale(img)
+    im = ImageOps.autocontrast(im)
+    # Same upscaling rule as single scans; small images become a single tile
+    scale = 2 if min(im.size) < 1000 else 1
+    # Overlap grows with the photo so a barcode's size relative to the frame, not in pixels, bounds detection
+    overlap = max(TILE_OVERLAP, int(max(im.size) * TILE_OVERLAP_FRACTION))
+    boxes = _tile_boxes(im.width, im.height, max(TILE_SIZE, 3 * overlap), overlap)
+
+    # pyzbar releases the GIL while zbar runs, so threads decode on all cores
+    workers = min(len(boxes), os.cpu_count() or 1)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        tile_results = pool.map(lambda box: _decode_tile(im, box, scale), boxes)
+        detections = _merge_detections([d for tile in tile_results for d in tile])
+
+    if not detections:
+        raise Exception("No barcode found in image")
+
+    max_products = max(1, min(max_products, MAX_PRODUCTS_PER_IMAGE))
+    detections = detections[:max_products]
+
+    # Look up each distinct barcode once, even if it appears several times
+    unique = {(d['type'], d['barcode']) for d in detections}
+    with ThreadPoolExecutor(max_workers=min(len(unique), LOOKUP_WORKERS)) as pool:
+        lookups = dict(zip(unique, pool.map(lambda key: _fetch_decoded(*key), unique)))
+
+    for det in detections:
+        data = lookups[(det['type'], det['barcode'])]
+        if data:
+            det['nutrition_data'] = data
+        else:
+            det['error'] = f"Product not found for barcode: {det['barcode']}"
+
+    return detections